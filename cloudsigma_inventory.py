@@ -1,4 +1,6 @@
-from typing import Any, List, Mapping
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Any, Mapping, Optional
+from urllib.parse import quote
 from ansible.errors import AnsibleError
 from ansible.plugins.inventory import BaseInventoryPlugin
 from ansible.plugins.inventory import Cacheable
@@ -70,38 +72,88 @@ DOCUMENTATION = r"""
 """
 
 
-_CLOUDSIGMA_REGIONS = {
-    "crk": {"location": "Clark, Philippines", "http_endpoint": "https://crk.cloudsigma.com/api/2.0/"},
-    "dub": {"location": "Dublin, Ireland", "http_endpoint": "https://ec.servecentric.com/api/2.0/"},
-    "fra": {"location": "Frankfurt, Germany", "http_endpoint": "https://fra.cloudsigma.com/api/2.0/"},
-    "gva": {"location": "Geneva, Switzerland", "http_endpoint": "https://gva.cloudsigma.com/api/2.0/"},
-    "hnl": {"location": "Honolulu, United States", "http_endpoint": "https://hnl.cloudsigma.com/api/2.0/"},
-    "lla": {"location": "Boden, Sweden", "http_endpoint": "https://cloud.hydro66.com/api/2.0/"},
-    "mel": {"location": "Melbourne, Australia", "http_endpoint": "https://mel.cloudsigma.com/api/2.0/"},
-    "mnl": {"location": "Manila, Philippines", "http_endpoint": "https://mnl.cloudsigma.com/api/2.0/"},
-    "mnl2": {"location": "Manila-2, Philippines", "http_endpoint": "https://mnl2.cloudsigma.com/api/2.0/"},
-    "per": {"location": "Perth, Australia", "http_endpoint": "https://per.cloudsigma.com/api/2.0/"},
-    "ruh": {"location": "Riyadh, Saudi Arabia", "http_endpoint": "https://ruh.cloudsigma.com/api/2.0/"},
-    "sjc": {"location": "San Jose, United States", "http_endpoint": "https://sjc.cloudsigma.com/api/2.0/"},
-    "tyo": {"location": "Tokyo, Japan", "http_endpoint": "https://tyo.cloudsigma.com/api/2.0/"},
-    "wdc": {"location": "Washington DC, United States", "http_endpoint": "https://wdc.cloudsigma.com/api/2.0/"},
-    "zrh": {"location": "Zurich, Switzerland", "http_endpoint": "https://zrh.cloudsigma.com/api/2.0/"},
+_CLOUDSIGMA_REGION_ENDPOINTS = {
+    "crk": "https://crk.cloudsigma.com/api/2.0/",  # Clark, Philippines
+    "dub": "https://ec.servecentric.com/api/2.0/",  # Dublin, Ireland
+    "fra": "https://fra.cloudsigma.com/api/2.0/",  # Frankfurt, Germany
+    "gva": "https://gva.cloudsigma.com/api/2.0/",  # Geneva, Switzerland
+    "hnl": "https://hnl.cloudsigma.com/api/2.0/",  # Honolulu, United States
+    "lla": "https://cloud.hydro66.com/api/2.0/",  # Boden, Sweden
+    "mel": "https://mel.cloudsigma.com/api/2.0/",  # Melbourne, Australia
+    "mnl": "https://mnl.cloudsigma.com/api/2.0/",  # Manila, Philippines
+    "mnl2": "https://mnl2.cloudsigma.com/api/2.0/",  # Manila-2, Philippines
+    "per": "https://per.cloudsigma.com/api/2.0/",  # Perth, Australia
+    "ruh": "https://ruh.cloudsigma.com/api/2.0/",  # Riyadh, Saudi Arabia
+    "sjc": "https://sjc.cloudsigma.com/api/2.0/",  # San Jose, United States
+    "tyo": "https://tyo.cloudsigma.com/api/2.0/",  # Tokyo, Japan
+    "wdc": "https://wdc.cloudsigma.com/api/2.0/",  # Washington DC, United States
+    "zrh": "https://zrh.cloudsigma.com/api/2.0/",  # Zurich, Switzerland
 }
 
 
 class InventoryModule(BaseInventoryPlugin, Constructable, Cacheable):
     NAME = "cloudsigma_inventory"
 
-    def __init__(self):
-        self._tags_uuid_map: Mapping
-        super(InventoryModule, self).__init__()
-
     def verify_file(self, path: str):
         """return true/false if this is possibly a valid file for this plugin to consume"""
         return super(InventoryModule, self).verify_file(path) and path.endswith(("cloudsigma.yaml", "cloudsigma.yml"))
 
-    def _get_server_tag_names(self, server: Any) -> List[str]:
-        return [self._tags_uuid_map[tag["uuid"]]["name"] for tag in server["tags"]]
+    def _get_inventory_cache_key(self, path: str, region: str, username: str) -> str:
+        # Cached results depend on the account being queried, not only on the inventory file.
+        # File based cache plugins use the key as a file name, so quote the username.
+        return f"{self.get_cache_key(path)}_{region}_{quote(username or '', safe='')}"
+
+    @staticmethod
+    def _get_public_ip_address(server: Any) -> Optional[str]:
+        # Servers that are not running have no runtime information
+        nics = server["nics"]
+        runtime = nics[0]["runtime"] if nics else None
+        if not runtime or not runtime.get("ip_v4"):
+            return None
+        return runtime["ip_v4"]["uuid"]
+
+    def _fetch_inventory_data(self, endpoint: str, username: str, password: str) -> Mapping:
+        # Both requests are independent, so run them in parallel. Every resource object
+        # owns its own HTTP client and is only ever used from the thread it runs in.
+        def list_tags():
+            return cloudsigma.resource.Tags(api_endpoint=endpoint, username=username, password=password).list()
+
+        def list_servers():
+            return cloudsigma.resource.Server(
+                api_endpoint=endpoint, username=username, password=password
+            ).list_detail()
+
+        results = {}
+        executor = ThreadPoolExecutor(max_workers=2)
+        try:
+            futures = {
+                executor.submit(list_tags): ("tags", f"{endpoint}tags/"),
+                executor.submit(list_servers): ("servers", f"{endpoint}servers/detail/"),
+            }
+            for future in as_completed(futures):
+                key, url = futures[future]
+                try:
+                    results[key] = future.result()
+                except Exception as e:
+                    raise AnsibleError(f"Failed to query {url}: {e}") from e
+        finally:
+            # Report a failed request right away instead of waiting for the other one to finish
+            executor.shutdown(wait=False)
+
+        # Keep only the fields parse() reads, the raw payload is far larger and may hold secrets
+        return {
+            "tags": [{"uuid": tag["uuid"], "name": tag["name"]} for tag in results["tags"]],
+            "servers": [
+                {
+                    "name": server["name"],
+                    "status": server["status"],
+                    "tag_uuids": [tag["uuid"] for tag in server["tags"]],
+                    "public_ip_address": self._get_public_ip_address(server),
+                    "meta": server["meta"],
+                }
+                for server in results["servers"]
+            ],
+        }
 
     def parse(self, inventory, loader, path, cache=True):
 
@@ -113,73 +165,104 @@ class InventoryModule(BaseInventoryPlugin, Constructable, Cacheable):
         self._read_config_data(path)
 
         region = self.get_option("cloudsigma_region").lower()
-        if not region in _CLOUDSIGMA_REGIONS:
-            raise (AnsibleError(f"Invalid region: {region}"))
+        endpoint = _CLOUDSIGMA_REGION_ENDPOINTS.get(region)
+        if endpoint is None:
+            raise AnsibleError(f"Invalid region: {region}")
 
-        endpoint = _CLOUDSIGMA_REGIONS[region]["http_endpoint"]
         username = self.get_option("cloudsigma_username")
         password = self.get_option("cloudsigma_password")
 
         group_tag_prefix = self.get_option("group_tag_prefix")
         include_running_only = self.get_option("include_running_only")
 
+        # Tag filters are checked for every server, convert them to sets once
         include_tags = self.get_option("include_tags")
+        include_tags = frozenset(include_tags) if include_tags is not None else None
         exclude_tags = self.get_option("exclude_tags")
+        exclude_tags = frozenset(exclude_tags) if exclude_tags is not None else None
+
+        cache_key = self._get_inventory_cache_key(path, region, username)
+        # Read the cache only when caching is enabled and --flush-cache was not requested,
+        # refresh it whenever caching is enabled and the data had to be fetched
+        user_cache_setting = self.get_option("cache")
+        attempt_to_read_cache = user_cache_setting and cache
+        cache_needs_update = user_cache_setting and not cache
+
+        results = None
+        if attempt_to_read_cache:
+            try:
+                results = self._cache[cache_key]
+            except KeyError:
+                cache_needs_update = True
 
-        servers = cloudsigma.resource.Server(api_endpoint=endpoint, username=username, password=password)
-        tags = cloudsigma.resource.Tags(api_endpoint=endpoint, username=username, password=password)
+        if results is None:
+            results = self._fetch_inventory_data(endpoint, username, password)
 
-        tag_list = tags.list()
-        self._tags_uuid_map = {tag["uuid"]: tag for tag in tag_list}
+        if cache_needs_update:
+            self._cache[cache_key] = results
 
-        server_list = servers.list_detail()
+        tag_list = results["tags"]
+        tag_names_by_uuid = {tag["uuid"]: tag["name"] for tag in tag_list}
 
+        server_list = results["servers"]
+        if include_running_only:
+            server_list = [server for server in server_list if server["status"] == "running"]
+
+        # Map every tag name carrying the group prefix to the group it represents
+        group_names_by_tag = {}
         if group_tag_prefix is not None:
-            for tag in tag_list:
-                tag_name = tag["name"]
-                if tag_name.startswith(group_tag_prefix):
-                    inventory.add_group(tag_name[len(group_tag_prefix) :])
+            prefix_length = len(group_tag_prefix)
+            group_names_by_tag = {
+                tag_name: tag_name[prefix_length:]
+                for tag_name in tag_names_by_uuid.values()
+                if tag_name.startswith(group_tag_prefix)
+            }
+        for group_name in group_names_by_tag.values():
+            inventory.add_group(group_name)
+
+        # Determines if composed variables or groups using nonexistent variables is an error
+        strict = self.get_option("strict")
+        compose = self.get_option("compose")
+        composed_groups = self.get_option("groups")
+        keyed_groups = self.get_option("keyed_groups")
+
+        add_host = inventory.add_host
+        set_variable = inventory.set_variable
 
-        server: cloudsigma.resource.Server
         for server in server_list:
-            if include_running_only and server["status"] != "running":
-                continue
             hostname = server["name"]
-            tag_names = self._get_server_tag_names(server)
+            tag_names = [tag_names_by_uuid[tag_uuid] for tag_uuid in server["tag_uuids"]]
 
-            if include_tags is not None:
-                if not any(tag in include_tags for tag in tag_names):
-                    continue
+            if include_tags is not None and include_tags.isdisjoint(tag_names):
+                continue
 
-            if exclude_tags is not None:
-                if any(tag in exclude_tags for tag in tag_names):
-                    continue
+            if exclude_tags is not None and not exclude_tags.isdisjoint(tag_names):
+                continue
 
             group_assigned = False
             for tag_name in tag_names:
-                if tag_name.startswith(group_tag_prefix):
-                    inventory.add_host(hostname, group=tag_name[len(group_tag_prefix) :])
+                group_name = group_names_by_tag.get(tag_name)
+                if group_name is not None:
+                    add_host(hostname, group=group_name)
                     group_assigned = True
             if not group_assigned:
-                inventory.add_host(hostname)
-
-            host_vars = {}
-            host_vars["public_ip_address"] = server["nics"][0]["runtime"]["ip_v4"]["uuid"]
-            host_vars["tags"] = tag_names
-            host_vars["server_name"] = hostname
-            if server["meta"]:
-                host_vars["meta"] = server["meta"]
+                add_host(hostname)
 
-            for var_name, var_value in host_vars.items():
-                self.inventory.set_variable(hostname, var_name, var_value)
+            public_ip_address = server["public_ip_address"]
+            set_variable(hostname, "public_ip_address", public_ip_address)
+            set_variable(hostname, "tags", tag_names)
+            set_variable(hostname, "server_name", hostname)
+            host_vars = {"public_ip_address": public_ip_address, "tags": tag_names, "server_name": hostname}
 
-            # Determines if composed variables or groups using nonexistent variables is an error
-            strict = self.get_option("strict")
+            meta = server["meta"]
+            if meta:
+                set_variable(hostname, "meta", meta)
+                host_vars["meta"] = meta
 
             # Add variables created by the user's Jinja2 expressions to the host
-            self._set_composite_vars(self.get_option("compose"), host_vars, hostname, strict=True)
+            self._set_composite_vars(compose, host_vars, hostname, strict=True)
 
             # The following two methods combine the provided variables dictionary with the latest host variables
             # Using these methods after _set_composite_vars() allows groups to be created with the composed variables
-            self._add_host_to_composed_groups(self.get_option("groups"), host_vars, hostname, strict=strict)
-            self._add_host_to_keyed_groups(self.get_option("keyed_groups"), host_vars, hostname, strict=strict)
+            self._add_host_to_composed_groups(composed_groups, host_vars, hostname, strict=strict)
+            self._add_host_to_keyed_groups(keyed_groups, host_vars, hostname, strict=strict)